@@ -8,7 +8,7 @@ from torchvision import transforms, models
 from pathlib import Path
 import matplotlib.pyplot as plt
 from dlcliche.utils import (ensure_delete, ensure_folder, get_logger,
-                            deterministic_everything, random, get_class_distribution)
+                            random, get_class_distribution)
 from dlcliche.image import show_np_image, subplot_matrix
 from dlcliche.math import n_by_m_distances, np_describe
 from sklearn import metrics
@@ -18,7 +18,7 @@ from arcface_pytorch.models import ArcMarginProduct
 
 from utils import (get_embeddings, get_body_model,
                    visualize_cnn_grad_cam, visualize_embeddings,
-                   maybe_this,
+                   maybe_this, seed_everything,
                    to_raw_image, set_model_param_trainable)
 from anotwin.train import train_model
 from anotwin.dataset import AnomalyTwinDataset, DefectOnBlobDataset, AsIsDataset
@@ -96,7 +96,7 @@ class AnoTwinDet(BaseAnoDet):
         base_seed = self.params.seed if 'seed' in self.params else 0
         if self.experiment_no is not None:
             base_seed += self.experiment_no
-        deterministic_everything(base_seed, pytorch=True)
+        seed_everything(base_seed, deterministic=maybe_this(self.params, 'deterministic', False))
         return base_seed
 
     def create_model(self, model_weights=None, **kwargs):
@@ -137,7 +137,7 @@ class AnoTwinDet(BaseAnoDet):
                            for x in ['train', 'val']}
         else:
             # convert train_set path names to file names.
-            train_set = [Path(f).name for f in train_set]
+            train_set = {Path(f).name for f in train_set}
             # get list of files in each set
             file_lists = {}
             file_lists['train'] = [f for f in train_samples if Path(f).name in train_set]
@@ -178,6 +178,7 @@ class AnoTwinDet(BaseAnoDet):
 
         self.dl = {x: data.DataLoader(self.ds[x], batch_size=self.batch_size,
                                       shuffle=True, num_workers=self.workers,
+                                      pin_memory=torch.cuda.is_available(),
                                       worker_init_fn=dataloader_worker_init_fn)
                    for x in ['train', 'val']}
 
@@ -188,7 +189,8 @@ class AnoTwinDet(BaseAnoDet):
                                          album_tfm=None, transform=None,
                                          online_pre_crop_rect=maybe_this(self.params.data, 'online_pre_crop_rect', None))
         self.dl['ref'] = data.DataLoader(self.ds['ref'], batch_size=self.batch_size,
-                                         shuffle=False, num_workers=self.workers)
+                                         shuffle=False, num_workers=self.workers,
+                                         pin_memory=torch.cuda.is_available())
 
     def create_test_dataset(self, test_samples, test_labels):
         self.ds['test'] = self.val_ds_cls(files=test_samples,
@@ -197,7 +199,8 @@ class AnoTwinDet(BaseAnoDet):
                                           album_tfm=None, transform=None,
                                           online_pre_crop_rect=maybe_this(self.params.data, 'online_pre_crop_rect', None))
         self.dl['test'] = data.DataLoader(self.ds['test'], batch_size=self.batch_size,
-                                          shuffle=False, num_workers=self.workers)
+                                          shuffle=False, num_workers=self.workers,
+                                          pin_memory=torch.cuda.is_available())
 
     def get_test_xx_most_info(self, most_test_idxs, distances, ref_ds, test_ds):
         most_train_idxs = np.argmin(distances[most_test_idxs], axis=1)
@@ -227,9 +230,17 @@ class AnoTwinDet(BaseAnoDet):
         d = torch.load(self._model_fn(save_name, 'metric-head'), map_location=self.device)
         self.metric_fc.load_state_dict(d)
 
-    def clf_forward(self, inputs, labels):
+    def forward_features(self, inputs):
+        """Backbone forward, returns flattened features for `metric_fc_only()`."""
         xs = self.model.forward(inputs)
-        return self.metric_fc(xs.reshape(xs.size(0), -1), labels)
+        return xs.reshape(xs.size(0), -1)
+
+    def metric_fc_only(self, feats, labels):
+        """Metric head forward, features can be shared among labels."""
+        return self.metric_fc(feats, labels)
+
+    def clf_forward(self, inputs, labels):
+        return self.metric_fc_only(self.forward_features(inputs), labels)
 
     def optimizer(self, kind, lr, weight_decay):
         if kind == 'sgd':
@@ -240,9 +251,11 @@ class AnoTwinDet(BaseAnoDet):
             opt = torch.optim.AdamW
         else:
             raise Exception('unknown opt')
+        # fused optimizer step: a few kernel launches instead of per-parameter ones
+        fused = {'fused': True} if self.device.type == 'cuda' and kind in ['adam', 'adamw'] else {}
         optimizer = opt([{'params': self.model.parameters()},
                          {'params': self.metric_fc.parameters()}],
-                        lr=lr, weight_decay=weight_decay)
+                        lr=lr, weight_decay=weight_decay, **fused)
         return optimizer
 
     def train_model(self, train_samples=None, save=True):
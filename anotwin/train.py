@@ -2,8 +2,10 @@ from dlcliche.utils import *
 from dlcliche.torch_utils import IntraBatchMixup
 import torch
 from torch import nn
+import sys
 import time
 import copy
+from utils import maybe_compile, unwrap_model, maybe_this
 
 
 def torch_flooding(loss, b):
@@ -12,20 +14,35 @@ def torch_flooding(loss, b):
 
 
 def _get_model_wts(det):
-    return {'model': det.model.state_dict(),
-            'metric_fc': det.metric_fc.state_dict()}
+    """Get copy of weights in host memory, state_dict() only returns references."""
+    def to_cpu(state_dict):
+        return {k: v.detach().to('cpu', copy=True) for k, v in state_dict.items()}
+    return {'model': to_cpu(unwrap_model(det.model).state_dict()),
+            'metric_fc': to_cpu(unwrap_model(det.metric_fc).state_dict())}
 
 
 def _set_model_wts(det, wts):
-    det.model.load_state_dict(wts['model'])
-    det.metric_fc.load_state_dict(wts['metric_fc'])
+    unwrap_model(det.model).load_state_dict(wts['model'])
+    unwrap_model(det.metric_fc).load_state_dict(wts['metric_fc'])
 
 
 def train_model(det, criterion, optimizer, scheduler,
                 dataloaders, num_epochs, flooding_b, device):
     since = time.time()
 
+    # fused kernels by torch.compile if params.compile is set, restored to eager model when training completes
+    compile_model = device.type == 'cuda' and maybe_this(det.params, 'compile', False)
+    det.model = maybe_compile(det.model, enabled=compile_model)
+    det.metric_fc = maybe_compile(det.metric_fc, enabled=compile_model)
+
     mixup_alpha = 0.0
+    accum_k = maybe_this(det.params, 'accum_steps', 1)
+
+    # mixed precision: bf16 on Ampere or later (not emulated), or fp16 with loss scaling
+    use_amp = device.type == 'cuda'
+    bf16 = use_amp and torch.cuda.get_device_capability(device)[0] >= 8
+    amp_dtype = torch.bfloat16 if bf16 else torch.float16
+    scaler = torch.amp.GradScaler(device.type, enabled=(use_amp and amp_dtype == torch.float16))
 
     best_model_wts = _get_model_wts(det)
     best_acc = 0.0
@@ -39,7 +56,8 @@ def train_model(det, criterion, optimizer, scheduler,
     for epoch in range(num_epochs):
         prm_grps = optimizer.param_groups[0]
         momentum_str = f' m:{prm_grps["momentum"]:.05f}' if 'momentum' in prm_grps else ''
-        print(f'Epoch {epoch}/{num_epochs} lr:{prm_grps["lr"]:.07f}{momentum_str}', end='')
+        # buffer the log, and write once per epoch
+        epoch_log = [f'Epoch {epoch}/{num_epochs} lr:{prm_grps["lr"]:.07f}{momentum_str}']
 
         # Each epoch has a training and validation phase
         for phase in ['train', 'val']:
@@ -50,61 +68,74 @@ def train_model(det, criterion, optimizer, scheduler,
                 det.model.eval()   # Set model to evaluate mode
                 det.metric_fc.eval()
 
-            running_loss = 0.0
-            running_corrects = 0
+            # accumulate on device, not to synchronize with host every batch
+            running_loss = torch.zeros((), device=device)
+            running_corrects = torch.zeros((), device=device, dtype=torch.long)
 
             # Make the albumentations do deterministically
             dataloaders[phase].dataset.set_epoch(epoch)
 
             # Iterate over data.
-            for inputs, labels in dataloaders[phase]:
-                inputs, labels = inputs.to(device), labels.to(device)
+            n_batches = len(dataloaders[phase])
+            for i, (inputs, labels) in enumerate(dataloaders[phase]):
+                inputs, labels = inputs.to(device, non_blocking=True), labels.to(device, non_blocking=True)
                 if batch_tfm:
                     inputs, labels = batch_tfm.transform(inputs, labels, train=(phase == 'train'))
 
-                # zero the parameter gradients
-                optimizer.zero_grad()
+                # zero the parameter gradients at the beginning of accumulation
+                if phase == 'train' and i % accum_k == 0:
+                    optimizer.zero_grad(set_to_none=True)
+                sync_step = (i + 1) % accum_k == 0 or (i + 1) == n_batches
+                # number of batches in this accumulation, the last one can be shorter
+                accum_n = min(accum_k, n_batches - (i - i % accum_k))
 
                 # forwaself.weightsdetrd
-                # track history if only in train
-                with torch.set_grad_enabled(phase == 'train'):
-                    if batch_tfm:
-                        outputs = det.clf_forward(inputs, labels[0])
-                        outputs2 = det.clf_forward(inputs, labels[1])
-                        loss = batch_tfm.criterion(outputs, labels, outputs2=outputs2)
-                    else:
-                        outputs = det.clf_forward(inputs, labels)
-                        loss = criterion(outputs, labels)
+                # track history if only in train, no autograd at all in val
+                grad_mode = torch.enable_grad() if phase == 'train' else torch.inference_mode()
+                with grad_mode:
+                    with torch.autocast(device_type=device.type, dtype=amp_dtype, enabled=use_amp):
+                        if batch_tfm:
+                            # backbone once, only the head depends on labels
+                            feats = det.forward_features(inputs)
+                            outputs = det.metric_fc_only(feats, labels[0])
+                            outputs2 = det.metric_fc_only(feats, labels[1])
+                            loss = batch_tfm.criterion(outputs, labels, outputs2=outputs2)
+                        else:
+                            outputs = det.clf_forward(inputs, labels)
+                            loss = criterion(outputs, labels)
+                    loss = loss.float()
                     _, preds = torch.max(outputs, 1)
 
-                    # flooding
+                    # flooding, in FP32
                     if flooding_b > 0.0 and phase == 'train':
                         loss = torch_flooding(loss, flooding_b)
 
                     # backward + optimize only if in training phase
                     if phase == 'train':
-                        loss.backward()
-                        optimizer.step()
+                        scaler.scale(loss / accum_n).backward()
+                        if sync_step:
+                            scaler.step(optimizer)
+                            scaler.update()
 
-                # statistics
-                running_loss += loss.item() * inputs.size(0)
-                running_corrects += torch.sum(preds == (labels[0] if batch_tfm else labels).data)
+                    # statistics
+                    running_loss += loss.detach() * inputs.size(0)
+                    running_corrects += (preds == (labels[0] if batch_tfm else labels)).sum()
 
             if phase == 'train':
                 scheduler.step()
 
-            epoch_loss = running_loss / dataset_sizes[phase]
-            epoch_acc = running_corrects.double() / dataset_sizes[phase]
+            epoch_loss = (running_loss / dataset_sizes[phase]).item()
+            epoch_acc = running_corrects.double().item() / dataset_sizes[phase]
 
-            print(f'  {phase} loss: {epoch_loss:.4f} acc: {epoch_acc:.4f}', end='')
+            epoch_log.append(f'  {phase} loss: {epoch_loss:.4f} acc: {epoch_acc:.4f}')
 
             # deep copy the model
             if phase == 'val' and epoch_loss < best_loss: #epoch_acc > best_acc:
                 best_acc = epoch_acc
                 best_loss = epoch_loss
                 best_model_wts = _get_model_wts(det)
-                print(f'\nUpdate: Best val acc/loss: {best_acc:4f}/{best_loss:4f}', end='')
-        print()
+                epoch_log.append(f'\nUpdate: Best val acc/loss: {best_acc:4f}/{best_loss:4f}')
+        sys.stdout.write(''.join(epoch_log) + '\n')
 
     time_elapsed = time.time() - since
     print(f'Training complete in {time_elapsed // 60:.0f}m {time_elapsed % 60:.0f}s')
@@ -113,6 +144,7 @@ def train_model(det, criterion, optimizer, scheduler,
     # load best model weights
     last_wts = _get_model_wts(det)
     _set_model_wts(det, best_model_wts)
+    det.model, det.metric_fc = unwrap_model(det.model), unwrap_model(det.metric_fc)
 
     return {
         'best_acc': best_acc,
@@ -12,9 +12,10 @@ def binary_clf_thresh_by_tpr(thresholds, tpr, min_tpr=1.0):
         thresh = bin_clf_thresh_by_tpr(thresholds, tpr, min_tpr=your_min_tpr)
     """
 
-    for th, rate in zip(thresholds, tpr):
-        if min_tpr <= rate:
-            return th
+    # tpr is monotonically non-decreasing, find the first one reaching min_tpr.
+    idx = np.searchsorted(tpr, min_tpr, side='left')
+    if idx < len(thresholds):
+        return thresholds[idx]
     assert tpr[-1] == 1.0, f'TPR should have 1.0 at the end, why?'
     return None
 
@@ -27,9 +28,10 @@ def binary_clf_thresh_by_fpr(thresholds, fpr, max_fpr=0.1):
         thresh = det.thresh_by_fpr(thresholds, fpr, max_fpr=your_max_fpr)
     """
 
-    for th, next_rate in zip(thresholds, fpr[1:]):
-        if max_fpr <= next_rate:
-            return th
+    # fpr is monotonically non-decreasing, find the one whose next reaches max_fpr.
+    idx = np.searchsorted(fpr[1:], max_fpr, side='left')
+    if idx < len(fpr) - 1:
+        return thresholds[idx]
     # Unfortunately or fortunately all threshold can be under the max_fpr.
     return thresholds[-1]
 
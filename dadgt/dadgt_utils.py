@@ -10,9 +10,10 @@ Implements simplified normality calculation.
 from dlcliche.utils import *
 from dlcliche.math import *
 
-import random
 import math
 import time
+import functools
+import hashlib
 import pandas as pd
 import numpy as np
 from PIL import Image
@@ -25,6 +26,7 @@ import torch.optim as optim
 from torchvision import transforms, models
 import torchsummary
 import pytorch_lightning as pl
+from pytorch_lightning.strategies import DDPStrategy
 
 from itertools import product
 from sklearn import metrics
@@ -57,52 +59,144 @@ class ImageTransform():
         return self.data_transform(img)
 
 
+def tensor_translate_fill_mirror(x, dx, dy):
+    """Translate (shift) batch of images (B, C, H, W) with filling mirror image at the edges.
+
+    Same as `pil_translate_fill_mirror`: shift is truncated to integer pixels,
+    positive dy moves image up, and mirror image includes the edge pixels.
+
+    Args:
+        dx, dy: Shift amount ratio of width/height.
+    """
+    H, W = x.shape[-2:]
+    sx, sy = int(dx * W), -int(dy * H)
+    # tile mirror images around, then crop shifted area
+    xp = torch.cat([x.flip(-1), x, x.flip(-1)], dim=-1)
+    xp = torch.cat([xp.flip(-2), xp, xp.flip(-2)], dim=-2)
+    return xp[..., H - sy:2*H - sy, W - sx:2*W - sx]
+
+
+def tensor_crop(x, crop_size, random_crop=False):
+    """Crop batch of images (B, C, H, W) at random position for each image, or at the center."""
+    B, _, H, W = x.shape
+    if not random_crop:
+        top, left = (H - crop_size) // 2, (W - crop_size) // 2
+        return x[..., top:top + crop_size, left:left + crop_size]
+    tops = torch.randint(0, H - crop_size + 1, (B,), device=x.device)
+    lefts = torch.randint(0, W - crop_size + 1, (B,), device=x.device)
+    offsets = torch.arange(crop_size, device=x.device)
+    rows, cols = tops[:, None] + offsets, lefts[:, None] + offsets
+    x = x.permute(0, 2, 3, 1)[torch.arange(B, device=x.device)[:, None, None], rows[:, :, None], cols[:, None, :]]
+    return x.permute(0, 3, 1, 2)
+
+
 class GeoTfmDataset(data.Dataset):
     """Geometric Transformation Dataset.
 
+    Each file is decoded and resized once, transformations are applied later
+    to the whole batch on its device by `apply_geo_tfms()` and `tensor_crop()`.
+    See `TrainingScheme.geo_tfm_batch()`.
+
+    Resized images are kept in LRU cache of `cache_size` images if it is set,
+    note that each worker process has its own cache. They are also stored
+    in `cache_folder` as `.pt` files if it is set.
+
     Yields:
-        image (tensor): Transformed image
-        label (int): Transformation label [0, n_tfm() - 1]
+        image (tensor): Resized image, not transformed yet
+        index (int): File index
     """
     geo_tfms = list(product(
         [None, Image.FLIP_LEFT_RIGHT], 
         [None, Image.ROTATE_90, Image.ROTATE_180, Image.ROTATE_270],
         [None, [0.1, 0], [-0.1, 0], [0, 0.1], [0, -0.1]],
     ))
+    flip_lr = {None: False, Image.FLIP_LEFT_RIGHT: True}
+    rot90_k = {None: 0, Image.ROTATE_90: 1, Image.ROTATE_180: 2, Image.ROTATE_270: 3}
 
-    def __init__(self, file_list, load_size, crop_size, transform, random, debug=None):
+    def __init__(self, file_list, load_size, crop_size, transform, random, debug=None,
+                 cache_size=0, cache_folder=None):
         self.file_list = file_list
         self.load_size, self.crop_size = load_size, crop_size
         self.transform, self.random, self.debug = transform, random, debug
+        self.cache_size, self.cache_folder = cache_size, cache_folder
+        if self.cache_folder is not None:
+            ensure_folder(self.cache_folder)
+        self._cache = None
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._make_tfm_tables()
+
+    @classmethod
+    def _make_tfm_tables(cls):
+        """Precompute lookup tables of geo_tfms: flip flag, rot90 k, translate dx and dy."""
+        cls._flip = np.array([cls.flip_lr[flip] for flip, _, _ in cls.geo_tfms])
+        cls._rot = np.array([cls.rot90_k[rotate] for _, rotate, _ in cls.geo_tfms])
+        cls._tx = np.array([0.0 if prms is None else prms[0] for _, _, prms in cls.geo_tfms])
+        cls._ty = np.array([0.0 if prms is None else prms[1] for _, _, prms in cls.geo_tfms])
+
+    def __getstate__(self):
+        # LRU cache is not picklable, workers will create their own.
+        state = self.__dict__.copy()
+        state['_cache'] = None
+        return state
 
     def __len__(self):
-        return len(self.file_list) * self.n_tfm()
+        return len(self.file_list)
 
     def __getitem__(self, index):
-        def apply_pil_tanspose(img, tfm_type):
-            return img if tfm_type is None else img.transpose(tfm_type)
-        def apply_pil_tanslate(img, prms):
-            return img if prms is None else pil_translate_fill_mirror(img, prms[0], prms[1])
-
         if self.debug is not None: print(f'{self.debug}[{index}]')
 
-        img_path = self.filename(index)
+        if not self.cache_size:
+            img = self._load_resized(index)
+        else:
+            if self._cache is None:
+                self._cache = functools.lru_cache(maxsize=self.cache_size)(self._load_resized)
+            img = self._cache(index)
+        # transform
+        img = self.transform(img)
+
+        return img, index
+
+    def _load_resized(self, file_index):
+        img_path = self.filename(file_index)
+        if self.cache_folder is not None:
+            # modification time in the key, not to use stale cache of updated file
+            key = hashlib.sha1(f'{img_path}:{os.path.getmtime(img_path)}:{self.load_size}'.encode()).hexdigest()
+            cache_file = Path(self.cache_folder)/f'{key}.pt'
+            if cache_file.exists():
+                return Image.fromarray(torch.load(cache_file, mmap=True).numpy())
         img = Image.open(img_path)
-        rot = index % self.n_tfm()
         # resize
         img = img.resize((self.load_size, self.load_size))
-        # geometric transform #1: flip
-        img = apply_pil_tanspose(img, self.geo_tfms[rot][0])
-        # geometric transform #2: rotate
-        img = apply_pil_tanspose(img, self.geo_tfms[rot][1])
-        # geometric transform #3: translate
-        img = apply_pil_tanslate(img, self.geo_tfms[rot][2])
-        # crop
-        img = pil_crop(img, crop_size=self.crop_size, random_crop=self.random)
-        # transform
-        img = self.transform(img)
+        if self.cache_folder is not None:
+            # write to temporary file first, other workers may read the same file
+            tmp_file = cache_file.with_suffix(f'.{os.getpid()}.tmp')
+            torch.save(torch.from_numpy(np.array(img)), tmp_file)
+            os.replace(tmp_file, cache_file)
+        return img
 
-        return img, rot
+    @classmethod
+    def apply_geo_tfms(cls, imgs):
+        """Apply all geometric transformations to batch of images (B, C, H, W).
+
+        Returns:
+            Transformed images (B * n_tfm(), C, H, W), ordered by transformation label in each image.
+        """
+        tfmd = []
+        for t in range(cls.n_tfm()):
+            x = imgs
+            # geometric transform #1: flip
+            if cls._flip[t]:
+                x = torch.flip(x, dims=(-1,))
+            # geometric transform #2: rotate
+            if cls._rot[t]:
+                x = torch.rot90(x, k=int(cls._rot[t]), dims=(-2, -1))
+            # geometric transform #3: translate
+            if cls._tx[t] or cls._ty[t]:
+                x = tensor_translate_fill_mirror(x, cls._tx[t], cls._ty[t])
+            tfmd.append(x)
+        return torch.stack(tfmd, dim=1).reshape(-1, *imgs.shape[1:])
 
     @classmethod
     def n_tfm(cls):
@@ -113,8 +207,10 @@ class GeoTfmDataset(data.Dataset):
         return list(range(cls.n_tfm()))
 
     def filename(self, index):
-        file_index = index // self.n_tfm()
-        return self.file_list[file_index]
+        return self.file_list[index]
+
+
+GeoTfmDataset._make_tfm_tables()
 
 
 class GeoTfm4Dataset(GeoTfmDataset):
@@ -136,18 +232,21 @@ class GeoTfm20Dataset(GeoTfmDataset):
 class GeoTfmEval(object):
     @staticmethod
     def simplified_normality(device, learner, files, n_class, bs_accel=8):
+        # NHWC memory format lets cuDNN use tensor core kernels
+        learner.model = learner.model.to(memory_format=torch.channels_last)
         learner.model.eval()
         ns = []
-        for x, _ in learner.get_dataloader(False, files, bs=bs_accel*n_class):
-            # predict for a file for all transformations
-            ps = learner.model(x.to(device)).softmax(-1)
-            ps = ps.detach().cpu().numpy()
-            ps = ps.reshape((-1, n_class, n_class))
-            # extract predictions for each transformations and take average of them -> normality
-            for p in ps:
-                n = p.diagonal().mean()
-                ns.append(n)
-        return ns
+        with torch.inference_mode(), torch.autocast(device_type=device.type, enabled=(device.type == 'cuda')):
+            for x, _ in learner.get_dataloader(False, files, bs=bs_accel*n_class):
+                # predict for a file for all transformations
+                x, _ = learner.geo_tfm_batch(x.to(device, non_blocking=True), random_crop=False)
+                x = x.contiguous(memory_format=torch.channels_last)
+                ps = learner.model(x).float().softmax(-1)
+                ps = ps.view(-1, n_class, n_class)
+                # extract predictions for each transformations and take average of them -> normality
+                ns.append(ps.diagonal(dim1=-2, dim2=-1).mean(-1))
+        # copy to host once
+        return torch.cat(ns).cpu().numpy()
 
     @staticmethod
     def calc(device, learner, files, labels, n_class, bs_accel=1):
@@ -161,38 +260,46 @@ class GeoTfmEval(object):
 class TrainingScheme(pl.LightningModule):
     """Training scheme by using PyTorch Lightning."""
 
-    def __init__(self, device, model, params, files, ds_cls):
+    def __init__(self, device, model, params, files, ds_cls, seed=None):
         super().__init__()
-        self.device = device
+        # `device` is managed by Lightning, models are moved by the Trainer.
         self.params = params
         self.model = model
         self.loss = torch.nn.CrossEntropyLoss()
-        # split data files
+        # split data files, by seeded permutation to be the same among DDP processes
         if files is not None:
             n_val = int(params.fit.validation_split * len(files))
-            self.val_files = random.sample(files, n_val)
-            self.train_files = [f for f in files if f not in self.val_files]
+            perm = np.random.default_rng(maybe_this(params, 'seed', 0) if seed is None else seed).permutation(len(files))
+            self.val_files = [files[i] for i in perm[:n_val]]
+            self.train_files = [files[i] for i in perm[n_val:]]
         self.ds_cls = ds_cls
 
     def forward(self, x):
         return self.model(x)
 
+    def geo_tfm_batch(self, x, random_crop):
+        """Apply all geometric transformations to batch of images on its device.
+
+        Returns:
+            Transformed images (len(x) * n_tfm, C, crop_size, crop_size) and transformation labels.
+        """
+        x = self.ds_cls.apply_geo_tfms(x)
+        x = tensor_crop(x, crop_size=self.params.crop_size, random_crop=random_crop)
+        y = torch.arange(self.ds_cls.n_tfm(), device=x.device).repeat(len(x) // self.ds_cls.n_tfm())
+        return x, y
+
     def training_step(self, batch, batch_nb):
-        x, y = batch
+        x, y = self.geo_tfm_batch(batch[0], random_crop=True)
         y_hat = self.forward(x)
         loss = self.loss(y_hat, y)
-        tensorboard_logs = {'train_loss': loss}
-        return {'loss': loss, 'log': tensorboard_logs}
+        self.log('train_loss', loss)
+        return loss
 
     def validation_step(self, batch, batch_nb):
-        x, y = batch
+        x, y = self.geo_tfm_batch(batch[0], random_crop=False)
         y_hat = self.forward(x)
-        return {'val_loss': self.loss(y_hat, y)}
-
-    def validation_epoch_end(self, outputs):
-        avg_loss = torch.stack([x['val_loss'] for x in outputs]).mean()
-        tensorboard_logs = {'val_loss': avg_loss}
-        return {'avg_val_loss': avg_loss, 'log': tensorboard_logs}
+        # averaged over the epoch, and across processes under DDP
+        self.log('val_loss', self.loss(y_hat, y), on_epoch=True, sync_dist=True)
 
     def configure_optimizers(self):
         optimizer = torch.optim.AdamW(self.parameters(), lr=self.params.fit.lr,
@@ -205,24 +312,36 @@ class TrainingScheme(pl.LightningModule):
         scheduler = {"scheduler": scheduler, "interval" : "step" }
         return [optimizer], [scheduler]
 
-    def get_dataloader(self, random_shuffle, files, bs=None): 
+    def get_dataloader(self, random_shuffle, files, bs=None, persistent=False): 
         ds = self.ds_cls(files,
                           load_size=self.params.load_size,
                           crop_size=self.params.crop_size,
                           transform=ImageTransform(),
-                          random=random_shuffle)
+                          random=random_shuffle,
+                          cache_size=maybe_this(self.params, 'cache_size', 0),
+                          cache_folder=maybe_this(self.params, 'cache_folder', None))
+        num_workers = maybe_this(self.params.fit, 'num_workers', 4)
+        # keep workers & prefetch more for loaders iterated every epoch, only available with worker processes
+        worker_kwargs = ({'persistent_workers': True, 'prefetch_factor': 4}
+                         if persistent and num_workers > 0 else {})
+        # each file will be expanded to all transformations of it
+        bs = self.params.fit.batch_size if bs is None else bs
         return torch.utils.data.DataLoader(ds,
-                        batch_size=self.params.fit.batch_size if bs is None else bs,
-                        shuffle=random_shuffle)
+                        batch_size=max(1, bs // ds.n_tfm()),
+                        shuffle=random_shuffle,
+                        num_workers=num_workers,
+                        pin_memory=torch.cuda.is_available(),
+                        **worker_kwargs)
 
     def train_dataloader(self):
-        return self.get_dataloader(True, self.train_files)
+        # Lightning replaces the sampler with DistributedSampler under DDP, and calls set_epoch().
+        return self.get_dataloader(True, self.train_files, persistent=True)
 
     def val_dataloader(self):
-        return self.get_dataloader(False, self.val_files)
+        return self.get_dataloader(False, self.val_files, persistent=True)
     
     def save(self, weight_file):
-        torch.save(self.model.state_dict(), weight_file)
+        torch.save(unwrap_model(self.model).state_dict(), weight_file)
 
 
 class DADGT(BaseAnoDet):
@@ -231,40 +350,60 @@ class DADGT(BaseAnoDet):
         super().__init__(params=params)
 
     def setup_train(self, train_samples):
-        deterministic_everything(self.params.seed + self.experiment_no, pytorch=True)
+        seed = self.params.seed + self.experiment_no
+        seed_everything(seed, deterministic=maybe_this(self.params, 'deterministic', False))
         self.weight_name = f'{self.params.work_folder}/weights-{self.test_target}-'
         #print(' model weight will be stored as:', self.weight_name)
 
-        self.learner = TrainingScheme(self.device, self.model, self. params, train_samples, self.params.ds_cls)
+        self.learner = TrainingScheme(self.device, self.model, self. params, train_samples, self.params.ds_cls,
+                                      seed=seed)
 
         # visualize to make sure data is fine
-        train_dataset = self.params.ds_cls(file_list=train_samples, load_size=self.params.load_size,
-                                           crop_size=self.params.crop_size, transform=ImageTransform(), random=True)
-        train_dataloader = torch.utils.data.DataLoader(train_dataset, batch_size=self.params.fit.batch_size, shuffle=True)
+        train_dataloader = self.learner.get_dataloader(True, train_samples)
+        train_dataset = train_dataloader.dataset
         batch_iterator = iter(train_dataloader)
-        imgs, labels = next(batch_iterator)
-        print(imgs.size(), labels.size(), len(train_dataset), len(train_dataloader), len(train_dataset.classes()))
+        imgs, labels = self.learner.geo_tfm_batch(next(batch_iterator)[0], random_crop=True)
+        print(imgs.size(), labels.size(), len(train_dataset) * train_dataset.n_tfm(), len(train_dataloader), len(train_dataset.classes()))
         np_imgs = [to_raw_image(img) for img in imgs[:10]]
         plt_tiled_imshow(imgs=np_imgs, titles=[str(l) for l in labels.detach().cpu().numpy()])
-        del train_dataset, train_dataloader
+        del train_dataset, train_dataloader, batch_iterator
 
     def create_model(self, weight_file=None, **kwargs):
         self.model = create_model(self.device, self.params.n_class, weight_file=weight_file)
+        self.model = maybe_compile(self.model,
+                                   enabled=(self.device.type == 'cuda' and maybe_this(self.params, 'compile', False)))
 
     def train_model(self, train_samples):
-        chkpt_callback = pl.callbacks.ModelCheckpoint(self.weight_name+'{epoch}-{val_loss:.2f}',
+        weight_path = Path(self.weight_name)
+        chkpt_callback = pl.callbacks.ModelCheckpoint(dirpath=weight_path.parent,
+                                                      filename=weight_path.name+'{epoch}-{val_loss:.2f}',
+                                                      monitor='val_loss', save_top_k=1,
                                                       verbose=True, save_weights_only=True)
 
-        trainer = pl.Trainer(max_epochs=self.params.fit.epochs, gpus=torch.cuda.device_count(),
-                             checkpoint_callback=chkpt_callback, show_progress_bar=self.params.fit.show_progress)
+        # single device by default. Set params.fit.strategy = 'ddp' for one process per GPU,
+        # only when running as a script: DDP re-launches the script on every GPU.
+        n_gpus = torch.cuda.device_count()
+        use_ddp = maybe_this(self.params.fit, 'strategy', 'auto') == 'ddp' and n_gpus > 1
+        if n_gpus > 0:
+            bf16 = torch.cuda.get_device_capability()[0] >= 8
+            accelerator, devices, precision = 'gpu', (n_gpus if use_ddp else 1), ('bf16-mixed' if bf16 else '16-mixed')
+        else:
+            accelerator, devices, precision = 'cpu', 1, '32-true'
+        strategy = DDPStrategy(gradient_as_bucket_view=True, static_graph=True) if use_ddp else 'auto'
+        trainer = pl.Trainer(max_epochs=self.params.fit.epochs, accelerator=accelerator, devices=devices,
+                             strategy=strategy, precision=precision, callbacks=[chkpt_callback],
+                             enable_progress_bar=self.params.fit.show_progress)
         trainer.fit(self.learner)
         self.load_saved_checkpoint()
+        # Lightning moves the module to CPU at teardown, bring it back for prediction
+        self.model.to(self.device)
 
     def load_saved_checkpoint(self):
         def remove_model(state_dict):
             replaced = {}
             for k in state_dict:
                 new_k = k.replace('model.', '') if 'model.' == k[:len('model.')] else k
+                new_k = new_k.replace('_orig_mod.', '') if '_orig_mod.' == new_k[:len('_orig_mod.')] else new_k
                 replaced[new_k] = state_dict[k]
             return replaced
         # find last saved (=best metric) checkpoint.
@@ -272,7 +411,7 @@ class DADGT(BaseAnoDet):
         path = max(path.parent.glob(path.name + '*.ckpt'), key=os.path.getctime)
         print(' loading checkpoint:', path)
         weights = remove_model(torch.load(path)['state_dict'])
-        self.model.load_state_dict(weights)
+        unwrap_model(self.model).load_state_dict(weights)
 
     def predict(self, test_samples, test_labels=None, return_raw=False):
         ns = GeoTfmEval.simplified_normality(self.device, self.learner, test_samples, self.params.n_class, bs_accel=1)
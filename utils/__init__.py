@@ -8,7 +8,7 @@ import matplotlib.pyplot as plt
 import torch
 from torch import nn
 from pytorch_cnn_visualizations.src.gradcam import GradCam
-from dlcliche.utils import ensure_folder, ensure_delete, is_array_like
+from dlcliche.utils import ensure_folder, ensure_delete, is_array_like, deterministic_everything
 from dlcliche.torch_utils import to_raw_image
 from dlcliche.image import (show_2D_tSNE, pil_crop, pil_translate_fill_mirror, plt_tiled_imshow, preprocess_images)
 
@@ -23,6 +23,33 @@ def set_model_param_trainable(model, flag):
         param.requires_grad = flag
 
 
+def seed_everything(seed, deterministic=False):
+    """Set random seeds, and make cuDNN deterministic only if required.
+    Otherwise cuDNN benchmark mode picks the fastest algorithms for fixed size inputs.
+    """
+    if deterministic:
+        deterministic_everything(seed, pytorch=True)
+        return
+    deterministic_everything(seed, pytorch=False)
+    torch.manual_seed(seed)
+    torch.backends.cudnn.deterministic = False
+    torch.backends.cudnn.benchmark = True
+
+
+def maybe_compile(model, enabled, mode='reduce-overhead'):
+    """Wrap model with `torch.compile` if enabled and available.
+    Compilation happens lazily at the first forward, and requires Triton capable GPU (sm_70 or later).
+    """
+    if not enabled or not hasattr(torch, 'compile') or hasattr(model, '_orig_mod'):
+        return model
+    return torch.compile(model, mode=mode)
+
+
+def unwrap_model(model):
+    """Return original model if it is wrapped by `torch.compile`."""
+    return getattr(model, '_orig_mod', model)
+
+
 def get_embeddings(embedding_model, data_loader, device, return_y=False):
     """Calculate embeddings for all samples in a data_loader.
     